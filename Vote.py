@@ -1,16 +1,139 @@
-from copy import deepcopy
-from math import ceil, floor
+import csv
+import io
+import warnings
+
+import numpy as np
+import pandas as pd
+from numba import njit, prange, set_num_threads
+
+
+@njit(inline="always")
+def _migrate (weights, pref_head, prefs, assignment, alive, src, wcoef,
+              max_depth):
+    """Move every vote assigned to participant src to its next running
+    preference, multiplying its weight by wcoef. Votes with no running
+    preference left become white (assignment -1). Arrays are updated in
+    place. prefs is depth-major: prefs[h, i] is preference h of vote i.
+
+    Always inlined into the kernels built by _make_run_phase, which pass
+    a constant max_depth.
+    """
+
+    rows = np.flatnonzero(assignment == src)
+    if rows.size == 0:
+        return
+    head = pref_head[rows]
+    landed = np.zeros(rows.size, dtype=np.bool_)
+    for k in prange(rows.size):
+        i = rows[k]
+        weights[i] *= wcoef
+        assignment[i] = -1
+        pref_head[i] = max_depth
+
+    # Running mask with a trailing False slot, so that the -1 padding of
+    # prefs looks up a participant that is never running
+    live = np.zeros(alive.shape[0] + 1, dtype=np.bool_)
+    live[:-1] = alive
+
+    # Walk the preferences one depth level at a time so each pass reads a
+    # single contiguous row of prefs, in vote order. Levels every moving
+    # vote has already passed are skipped. The conditions are combined
+    # without branching so LLVM can vectorize the inner loop. Every
+    # iteration only touches vote rows[k], so votes are split across
+    # threads.
+    for h in range(head.min() + 1, max_depth):
+        level = prefs[h]
+        for k in prange(rows.size):
+            i = rows[k]
+            c = level[i]
+            take = (not landed[k]) & (h > head[k]) & live[c]
+            assignment[i] = c if take else assignment[i]
+            pref_head[i] = h if take else pref_head[i]
+            landed[k] = landed[k] | take
+
+
+_run_phases = {}
+
+
+def _make_run_phase (max_depth):
+    """Return the run_phase kernel for votes of max_depth preferences. The
+    depth is a compile time constant inside the kernel, so LLVM knows the
+    trip count of the walk over preference levels and can unroll it. The
+    kernel is compiled eagerly from its signature, once per depth, and
+    cached in __pycache__ (cache=True) so only the first run with a given
+    depth pays the compile cost.
+    """
+
+    if max_depth in _run_phases:
+        return _run_phases[max_depth]
+
+    @njit("Tuple((int64, int64, float64[::1]))(float32[::1], int16[::1], "
+          "int16[:, ::1], int16[::1], boolean[::1], int64, int64)",
+          parallel=True, cache=True, nogil=True)
+    def run_phase (weights, pref_head, prefs, assignment, alive, quota,
+                   open_seats):
+        """Run a single election phase on the vote arrays: tally the votes,
+        elect the first participant if it reaches quota or else eliminate
+        the last one, and migrate the votes of whoever left the race. If
+        after an elimination only open_seats participants are still
+        running they all win and are marked as not alive as well.
+
+        Returns (winner, eliminated, totals): the ids of the participant
+        who won or was eliminated, one of which is -1 (both if no
+        participant is running), and the tallies the decision was made on.
+        """
+
+        totals = np.zeros(alive.shape[0])
+        for i in range(weights.shape[0]):
+            if assignment[i] >= 0:
+                totals[assignment[i]] += weights[i]
+
+        # Only running participants may be picked as winner/loser. Ties go
+        # to the lowest id.
+        first = -1
+        last = -1
+        running = 0
+        for c in range(alive.shape[0]):
+            if not alive[c]:
+                continue
+            running += 1
+            if first < 0 or totals[c] > totals[first]:
+                first = c
+            if last < 0 or totals[c] < totals[last]:
+                last = c
+        if running == 0:
+            return -1, -1, totals
+
+        # The migration is inlined once, with the source picked here
+        if totals[first] >= quota:  # There is a winner
+            last = -1
+            source = first
+            wcoef = (totals[first] - quota) / totals[first]
+        else:                       # Last in ranking must be eliminated
+            first = -1
+            source = last
+            wcoef = 1.0
+            if running - 1 == open_seats:
+                alive[:] = False
+        alive[source] = False
+        _migrate(weights, pref_head, prefs, assignment, alive,
+                 np.int16(source), np.float32(wcoef), max_depth)
+        return first, last, totals
+
+    _run_phases[max_depth] = run_phase
+    return run_phase
+
 
 class Vote:
     """A single vote.
     """
     
-    def __init__ (self, prefs = []):
+    def __init__ (self, prefs = None):
         """Creates the vote using the given list of preferences. If no list is
         passed, creates a white vote.
         """
         
-        self.prefs = deepcopy (prefs)
+        self.prefs = list(prefs) if prefs else []
         self.weight = 1.0
 
     def first_choice (self):
@@ -48,123 +171,96 @@ class Vote:
         self.prefs.pop(0)
 
     def __str__ (self):
-        ret = ""
-        for pref in self.prefs:
-            ret += pref+"\n"
-        return ret+"weight = "+str(self.weight)
+        return "\n".join(self.prefs + [f"weight = {self.weight}"])
 
 
 class Participant:
-    """A single participant. Every participant holds a list of votes
-    assigned to him.
+    """A single participant. Votes are not stored on the participant; the
+    context keeps them in flat arrays indexed by the participant id.
     """
     
-    def __init__ (self, name):
-        self.name = deepcopy (name)
-        self.votes = []
-
-    def count_votes (self):
-        """Return the number of votes currently assigned to the participant object.
-        """
-        
-        ret = 0
-        for vote in self.votes:
-            ret += vote.weight
-        return ret
-
-    def add_vote (self, vote):
-        """Assigns given vote to participant.
-        """
-        
-        self.votes.append(vote) #This does not actually copy the vote object
-
-    def destroy_white_votes (self):
-        """Destroys white votes assigned to the participant.
-        """
-
-        self.votes = [vote for vote in self.votes if not vote.is_white()]
-
-    def clear (self):
-        """Empties the list of votes. This is useful when moving votes to next
-        preference in order to avoid duplicate pointers.
-        """
-
-        self.votes = []
+    def __init__ (self, name, pid):
+        self.name = name
+        self.id = pid
+        self.votes = 0.0        # Tally at the start of the last phase
 
     def __str__ (self):
-        ret = "Participant name: " + self.name
-        ret += "\nVotes: " + str (self.count_votes())
-        return ret
+        return f"Participant name: {self.name}\nVotes: {self.votes}"
 
 class Context:
-    def __init__ (self, participants, seats, votes):
+    """Election state. Votes are stored as a struct of arrays of int16
+    ids and float32 weights: column i of prefs holds the participant ids
+    of vote i in order of preference (padded with -1), pref_head[i] is
+    the row of the preference currently holding the vote, assignment[i]
+    is that participant's id (-1 once the vote has become white) and
+    weights[i] is its weight.
+    participants is indexed by id and alive marks the ones still running;
+    winner_ids and eliminated_ids record the others in order.
+
+    threads sets the number of threads used when migrating votes. By
+    default numba uses all cores, or NUMBA_NUM_THREADS if set.
+    """
+
+    def __init__ (self, participants, seats, votes, threads = None):
+
+        if threads is not None:
+            set_num_threads(threads)
 
         self.participants = self.get_participants(participants)
+        self.ncand = len(self.participants)
+        self.name_of = np.array([p.name for p in self.participants])
+        self.alive = np.ones(self.ncand, dtype=bool)
         self.seats = seats
-        self.votes = self.get_votes(votes)
-        self.winners = []
-        self.eliminated = []
+        self.prefs = self.get_votes(votes)
+        self.winner_ids = []
+        self.eliminated_ids = []
         self.phase = 0
         self.destroy_white_votes()
-        self.quota = 1.0 + (len(self.votes)/(self.seats+1.0))
-        self.quota = ceil(self.quota)
+        nvotes = self.prefs.shape[1]
+        self.weights = np.ones(nvotes, dtype=np.float32)
+        self.pref_head = np.zeros(nvotes, dtype=np.int16)
+        self.assignment = np.full(nvotes, -1, dtype=np.int16)
+        self.totals = np.zeros(self.ncand)  # Tallies of the last phase
+        # ceil(1 + nvotes/(seats+1)) in integer arithmetic
+        self.quota = 1 + (nvotes + self.seats) // (self.seats + 1)
+        self._run_phase = _make_run_phase(self.prefs.shape[0])
 
     def destroy_white_votes (self):
         """Remove all white votes from the context.
         """
         
-        self.votes = [vote for vote in self.votes if not vote.is_white()]
+        valid = self.prefs[0] >= 0
+        self.prefs = np.ascontiguousarray(self.prefs[:, valid])
 
     def complete (self):
         """Returns True if election is over or False if it isn't.
         """
         
-        if len(self.winners) == self.seats:
+        if len(self.winner_ids) == self.seats:
             return True
         else:
             return False
 
     def find_participant (self, name):
-        """Return candidate which matches passed name.
+        """Return id of the running candidate which matches passed name, or
+        None if there is no such candidate or it has won or been eliminated.
         """
 
-        for participant in self.participants:
-            if participant.name == name:
-                return participant
+        pid = self._id.get(name)
+        if pid is not None and self.alive[pid]:
+            return pid
         return None
 
-    def migrate (self, source, wcoef):
-        """Migrate votes from source to next preference of each vote.
-        """
-
-        for vote in source.votes:
-            vote.update (wcoef)
-            
-            # Cycle throught vote's preferences until valid participant is found
-            # or vote has become white
-            while not vote.is_white():
-                first_choice = self.find_participant (vote.first_choice())
-
-                # None means the participant has won or has been eliminated
-                if first_choice is not None:
-                    first_choice.add_vote(vote)
-                    break
-                else:
-                    vote.update() # Remove the first choice
-        source.clear()
-
     def election_loop (self):
         """Handles the whole election process by repeatedly calling election phase until
         all seats are filled.
         """
 
         # Initialize by assigning all votes to their first choice
-        for vote in self.votes:
-            p = self.find_participant(vote.first_choice())
-            p.add_vote (vote)
+        self.pref_head[:] = 0
+        self.assignment[:] = self.prefs[0]
 
         while not self.complete():
-            import ipdb; ipdb.set_trace()
             self.election_phase()
 
     def election_phase (self):
@@ -174,34 +270,32 @@ class Context:
 
         self.phase += 1
 
-        #Sorting the participants makes it easier to find the winner/loser
-        self.participants.sort(key=lambda p:p.count_votes(), reverse=True)
-
-        first = self.participants [0]
+        first, last, self.totals = self._run_phase(
+            self.weights, self.pref_head, self.prefs, self.assignment,
+            self.alive, self.quota, self.seats - len(self.winner_ids))
+        for p in self.participants:
+            p.votes = self.totals[p.id]
 
-        if first.count_votes() >= self.quota: # There is a winner
+        if first < 0 and last < 0:
+            raise ValueError(f"not enough participants to fill "
+                             f"{self.seats} seats")
 
-            # Move winner from participants to winners
-            self.winners.append(first)
-            self.participants.pop(0)
+        if first >= 0:          # There is a winner
+            self.winner_ids.append(first)
 
-            no_of_votes = first.count_votes()
-            wcoef = (no_of_votes - self.quota) / no_of_votes
-            source = first      # Source of votes to move
-
-        else:                   # Last in ranking must be eliminated
-            last = self.participants.pop()
-            self.eliminated.append(last)
-            wcoef = 1.0
-            source = last
+        else:                   # Last in ranking was eliminated
+            self.eliminated_ids.append(last)
 
             # If after elimination, number of seats left is equal to
-            # participants still running, they automatically win
-            if len(self.winners) + len (self.participants) == self.seats:
-                self.winners = self.winners + self.participants
-                self.participants = []
-
-        self.migrate(source, wcoef)
+            # participants still running, they automatically win in order
+            # of votes. The kernel has already marked them as not alive.
+            if not self.alive.any():
+                decided = np.zeros(self.ncand, dtype=bool)
+                decided[self.winner_ids] = True
+                decided[self.eliminated_ids] = True
+                rest = np.flatnonzero(~decided)
+                rest = rest[np.argsort(-self.totals[rest], kind="stable")]
+                self.winner_ids.extend(rest.tolist())
 
     def get_participants (self, filename):
         """Get list of participant names from given file. Otherwise get user input.
@@ -210,7 +304,7 @@ class Context:
         #filename = raw_input ("Specify file of participant names (leave blank "
         #                      "to input names manually)\n")
         if len(filename) == 0:
-            pnames = raw_input("Enter participant names seperated by spaces\n")
+            pnames = input("Enter participant names seperated by spaces\n")
 
         else:
             f = open (filename, "r")
@@ -218,56 +312,99 @@ class Context:
 
         #Split string into list and remove duplicates
         pnames = list(set(pnames.split()))
-        participants = [Participant(name) for name in pnames]
+        # Ids are stored as int16
+        if len(pnames) > np.iinfo(np.int16).max:
+            raise ValueError(f"too many participants: {len(pnames)}")
+        participants = [Participant(name, i) for i, name in enumerate(pnames)]
+        self._id = dict((name, i) for i, name in enumerate(pnames))
         return participants
 
     def get_seats (self):
-        seats = int (raw_input ("Specify number of seats to be filled\n"))
+        seats = int (input ("Specify number of seats to be filled\n"))
         while seats < 1:
-            seats = raw_input("Seats must be positive integer\n")
+            seats = input("Seats must be positive integer\n")
         return seats
 
     def get_votes (self, filename = None):
+        """Read votes and return them as a matrix of participant ids, one
+        column per vote, padded with -1. White votes are columns of -1. The
+        matrix is depth-major so that each preference level is contiguous.
+        """
         #filename = raw_input ("Specify file of votes (leave blank to input "
         #                      "names manually)\n")
 
-        votes = []
         if len(filename) == 0:
-            prefs = raw_input("Input votes seperated by newlines (single empty"
-                              "space for white vote)\n")
+            lines = []
+            prefs = input("Input votes seperated by newlines (single empty"
+                          "space for white vote)\n")
             while len(prefs) != 0:
-                prefs = prefs.split()
-                votes.append(Vote(prefs))
-                prefs = raw_input()
+                lines.append(prefs)
+                prefs = input()
+            source = io.StringIO("\n".join(lines))
         else:
-            f = open(filename, "r")
-            inp = f.read()
-            for prefs in inp.split("\n"):
-                votes.append(Vote(prefs.split())) # Create list out of every
-                                                  # line before creating vote
-        return votes
+            source = filename
+
+        # Let the C tokenizer split the ballots into a table. Names are
+        # taken literally, with no NA markers or quoting. A vote normally
+        # ranks every participant at most once, so start with one spare
+        # column and widen the table until the spare column stays empty.
+        # Blank lines are white votes and are skipped.
+        width = self.ncand + 1
+        while True:
+            if hasattr(source, "seek"):
+                source.seek(0)
+            with warnings.catch_warnings():
+                # Rows wider than the table are truncated, which shows up
+                # as a filled spare column
+                warnings.simplefilter("ignore", pd.errors.ParserWarning)
+                try:
+                    table = pd.read_csv(source, sep=r"\s+", header=None,
+                                        names=range(width), index_col=False,
+                                        dtype=str, keep_default_na=False,
+                                        na_values=[],
+                                        quoting=csv.QUOTE_NONE, engine="c")
+                except pd.errors.EmptyDataError:
+                    table = pd.DataFrame(columns=range(width), dtype=str)
+            if not (table[width - 1] != "").any():
+                break
+            width *= 2
+
+        # Map names to ids with a single hash lookup; empty cells become -1
+        values = table.to_numpy()
+        present = values != ""
+        ids = pd.Index(self.name_of).get_indexer(values.ravel())
+        ids = ids.reshape(values.shape)
+        unknown = (ids < 0) & present
+        if unknown.any():
+            raise KeyError(values[unknown][0])
+
+        max_depth = max(present.sum(axis=1).max(initial=0), 1)
+        # pref_head is stored as int16 and may hold max_depth
+        if max_depth > np.iinfo(np.int16).max:
+            raise ValueError(f"too many preferences in a vote: {max_depth}")
+        return np.ascontiguousarray(ids[:, :max_depth].T, dtype=np.int16)
 
     def __str__ (self):
         """Print list of participant names and number of seats
         """
 
-        ret = ""
-        if len(self.winners) > 0:
-            ret += "Winners:\n"
-            for w in self.winners:
-                ret += w.name + "\n"
-            ret += "\n"
-        if len(self.eliminated) > 0:
-            ret += "Eliminated:\n"
-            for el in self.eliminated:
-                ret += el.name + "\n"
-            ret += "\n"
-        if len(self.participants) > 0:
-            ret += "Still running:\n"
-            for p in self.participants:
-                ret += p.name + "\n"
-        return ret
+        lines = []
+        if len(self.winner_ids) > 0:
+            lines.append("Winners:")
+            lines.extend(self.participants[w].name for w in self.winner_ids)
+            lines.append("")
+        if len(self.eliminated_ids) > 0:
+            lines.append("Eliminated:")
+            lines.extend(self.participants[el].name
+                         for el in self.eliminated_ids)
+            lines.append("")
+        if self.alive.any():
+            lines.append("Still running:")
+            lines.extend(p.name for p in self.participants if self.alive[p.id])
+        if len(lines) == 0:
+            return ""
+        return "\n".join(lines) + "\n"
 
 con = Context ("Participants.txt", 3, "Votes.txt")
 con.election_loop()
-print con
+print(con)